@@ -1,8 +1,15 @@
+import collections
+import functools
+import hashlib
 import io
+import json
 import math
+import multiprocessing
 import os
 import re
 import random
+import shutil
+import subprocess
 import sys
 import time
 from datetime import datetime
@@ -13,19 +20,35 @@ import concurrent.futures
 import threading
 
 import requests
+from urllib3.util.retry import Retry
 
-from PIL import Image, ImageOps, ImageChops
+from PIL import Image, ImageChops
 Image.MAX_IMAGE_PIXELS = None
 
 
 TILE_SIZE = 256  # in pixels
 EARTH_CIRCUMFERENCE = 40075.016686 * 1000  # in meters, at the equator
+METERS_PER_DEGREE = EARTH_CIRCUMFERENCE / 360  # at the equator, too
 
 USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36"
 
 DEFAULT_VERSION = 908
 DEFAULT_OBLIQUE_VERSION = 131  # both as of early October, 2021
 
+# for extracting the current versions from the google maps javascript api
+VERSION_PATTERN = re.compile(rb'null,\[\[\"https:\/\/khms0\.googleapis\.com\/kh\?v=([0-9]+)')
+OBLIQUE_VERSION_PATTERN = re.compile(rb'\],\[\[\"https:\/\/khms0\.googleapis\.com\/kh\?v=([0-9]+)')
+
+# a single session shared by all requests, so connections to the tile servers
+# are kept alive and reused across tiles (and versions) instead of paying for a
+# fresh tcp and tls handshake on every request
+SESSION = requests.Session()
+SESSION.headers["User-Agent"] = USER_AGENT
+
+# connect and read timeouts (in seconds) for all requests, such that a stalled
+# connection results in an error (and a retry) instead of hanging forever
+TIMEOUT = (3.05, 10)
+
 
 class ViewDirection:
     """
@@ -82,6 +105,17 @@ class ViewDirection:
 class WebMercator:
     """Various functions related to the Web Mercator projection."""
 
+    @staticmethod
+    @functools.lru_cache(maxsize=32)
+    def _factor(zoom):
+        """
+        Scale factor from radians to tile coordinates at the given zoom level.
+        Only depends on the zoom level, which is constant throughout a run, so
+        it's cached instead of being recomputed on every projection.
+        """
+
+        return (1 / (2 * math.pi)) * 2 ** zoom
+
     @staticmethod
     def project(geopoint, zoom):
         """
@@ -92,9 +126,12 @@ class WebMercator:
         here.
         """
 
-        factor = (1 / (2 * math.pi)) * 2 ** zoom
+        factor = WebMercator._factor(zoom)
         x = factor * (math.radians(geopoint.lon) + math.pi)
-        y = factor * (math.pi - math.log(math.tan((math.pi / 4) + (math.radians(geopoint.lat) / 2))))
+        # ln(tan(π/4 + φ/2)) (the isometric latitude) rewritten as asinh(tan(φ)),
+        # which is mathematically equivalent, but cheaper to evaluate and more
+        # precise near the equator
+        y = factor * (math.pi - math.asinh(math.tan(math.radians(geopoint.lat))))
         return (x, y)
 
 
@@ -159,6 +196,8 @@ class GeoPoint:
     https://stackoverflow.com/questions/7309121/preferred-order-of-writing-latitude-longitude-tuples
     """
 
+    __slots__ = ("lat", "lon", "_cos_lat")
+
     def __init__(self, lat, lon):
         assert -90 <= lat <= 90 and -180 <= lon <= 180
 
@@ -168,16 +207,18 @@ class GeoPoint:
     def __repr__(self):
         return f"GeoPoint({self.lat}, {self.lon})"
 
-    def to_maptile(self, version, zoom, direction):
+    @property
+    def cos_lat(self):
         """
-        Conversion of this geopoint to a tile through application of the Web
-        Mercator projection and flooring to get integer tile corrdinates.
+        The factor by which distances along this point's circle of latitude
+        shrink compared to the equator. Computed on first access, then cached.
         """
 
-        x, y = WebMercator.project(self, zoom)
-        if direction.is_oblique():
-            x, y = ObliqueWebMercator.project(self, zoom, direction)
-        return MapTile(version, zoom, direction, math.floor(x), math.floor(y))
+        try:
+            return self._cos_lat
+        except AttributeError:
+            self._cos_lat = math.cos(math.radians(self.lat))
+            return self._cos_lat
 
     def compute_zoom_level(self, max_meters_per_pixel):
         """
@@ -186,23 +227,29 @@ class GeoPoint:
         https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames#Resolution_and_Scale
         """
 
-        meters_per_pixel_at_zoom_0 = ((EARTH_CIRCUMFERENCE / TILE_SIZE) * math.cos(math.radians(self.lat)))
+        meters_per_pixel_at_zoom_0 = ((EARTH_CIRCUMFERENCE / TILE_SIZE) * self.cos_lat)
+
+        # each zoom level halves the meters per pixel, so instead of scanning
+        # through all zoom levels, solve meters_per_pixel_at_zoom_0 / 2 ** zoom
+        # <= max_meters_per_pixel for the smallest integer zoom level directly
+        zoom = math.ceil(math.log2(meters_per_pixel_at_zoom_0 / max_meters_per_pixel))
+
+        # log2 isn't exact, which matters right at the boundary between two zoom
+        # levels, so make sure the constraint holds exactly as if it had been
+        # checked level by level
+        if meters_per_pixel_at_zoom_0 / 2 ** zoom > max_meters_per_pixel:
+            zoom += 1
+        elif meters_per_pixel_at_zoom_0 / 2 ** (zoom - 1) <= max_meters_per_pixel:
+            zoom -= 1
 
         # 23 seems to be highest zoom level supported anywhere in the world, see
         # https://stackoverflow.com/a/32407072 (although 19 or 20 is the highest
         # in many places in practice)
-        for zoom in reversed(range(0, 23+1)):
-            meters_per_pixel = meters_per_pixel_at_zoom_0 / (2 ** zoom)
-
-            # once meters_per_pixel eclipses the maximum, we know that the
-            # previous zoom level was correct
-            if meters_per_pixel > max_meters_per_pixel:
-                return zoom + 1
-        else:
-
-            # if no match, the required zoom level would have been too high
+        if zoom > 23:
             raise RuntimeError("your settings seem to require a zoom level higher than is commonly available")
 
+        return max(zoom, 0)
+
 
 class GeoRect:
     """
@@ -220,9 +267,31 @@ class GeoRect:
         self.sw = sw
         self.ne = ne
 
+        # see `project`
+        self.projections = {}
+
     def __repr__(self):
         return f"GeoRect({self.sw}, {self.ne})"
 
+    def project(self, zoom, direction):
+        """
+        Projects the corners of the rectangle into (fractional) tile coordinates
+        for the given zoom level and view direction, returning them as a (left,
+        bottom, right, top) tuple. Since the same rectangle is turned into a
+        grid of tiles once per version, the result is memoized.
+        """
+
+        key = (zoom, direction.angle)
+        if key not in self.projections:
+            if direction.is_oblique():
+                left, bottom = ObliqueWebMercator.project(self.sw, zoom, direction)
+                right, top = ObliqueWebMercator.project(self.ne, zoom, direction)
+            else:
+                left, bottom = WebMercator.project(self.sw, zoom)  # sw_x, sw_y
+                right, top = WebMercator.project(self.ne, zoom)  # ne_x, ne_y
+            self.projections[key] = (left, bottom, right, top)
+        return self.projections[key]
+
     @classmethod
     def around_geopoint(cls, geopoint, width, height):
         """
@@ -234,10 +303,8 @@ class GeoRect:
 
         assert width > 0 and height > 0
 
-        meters_per_degree = (EARTH_CIRCUMFERENCE / 360)
-
-        width_geo = width / (meters_per_degree * math.cos(math.radians(geopoint.lat)))
-        height_geo = height / meters_per_degree
+        width_geo = width / (METERS_PER_DEGREE * geopoint.cos_lat)
+        height_geo = height / METERS_PER_DEGREE
 
         southwest = GeoPoint(geopoint.lat - height_geo / 2, geopoint.lon - width_geo / 2)
         northeast = GeoPoint(geopoint.lat + height_geo / 2, geopoint.lon + width_geo / 2)
@@ -254,30 +321,241 @@ class MapTileStatus:
     ERROR = 4
 
 
+class VersionCache:
+    """
+    Remembers the most recently determined current versions (one for satellite
+    imagery, one for the oblique kind) on disk for a few minutes, such that
+    running the script several times in a row – say, for different directions
+    or areas – doesn't require fetching and searching the google maps
+    javascript api every single time. Since this is merely an optimization, any
+    problems with reading or writing the cache file are silently ignored.
+    """
+
+    def __init__(self, path, ttl=10 * 60):
+        self.path = path
+        self.ttl = ttl  # in seconds
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        # valid json, but not written by us
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def get(self, kind):
+        """Returns the cached version of the given kind, or None if stale."""
+
+        entry = self.read().get(kind)
+        if not isinstance(entry, dict):
+            return None
+        version, timestamp = entry.get("version"), entry.get("timestamp")
+        if not isinstance(version, int) or not isinstance(timestamp, (int, float)):
+            return None
+        if not 0 <= time.time() - timestamp < self.ttl:
+            return None
+        return version
+
+    def put(self, kind, version):
+        entries = self.read()
+        entries[kind] = {"version": version, "timestamp": time.time()}
+
+        # write to a temporary file first and move it into place, such that
+        # concurrently running instances never see a half-written file
+        temporary_path = f"{self.path}.{os.getpid()}"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(temporary_path, "w") as f:
+                json.dump(entries, f)
+            os.replace(temporary_path, self.path)
+        except (OSError, ValueError):
+
+            # don't leave partially written temporary files lying around
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
+
+
+VERSION_CACHE = VersionCache(os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "google-maps-at-88-mph",
+    "versions.json"
+))
+
+
+class TileCache:
+    """
+    Remembers the most recently downloaded response body of each tile position
+    along with its ETag, such that downloads of the same position for other
+    versions can be made conditional: if the server deems the imagery unchanged
+    and responds with "304 Not Modified", the cached bytes are reused instead of
+    being downloaded again. Shared between all download threads.
+
+    Huge grids would make this grow without bound, so once more than max_bytes
+    worth of response bodies are cached, the least recently used ones are
+    evicted (which merely costs an unconditional download later on).
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns an (etag, data) tuple, or None if nothing is cached."""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, etag, data):
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries[key][1])
+            self.entries[key] = (etag, data)
+            self.entries.move_to_end(key)
+            self.size += len(data)
+
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+TILE_CACHE = TileCache()
+
+
+class Throttle:
+    """
+    Limits the number of concurrent tile downloads, adapting to how well the
+    tile servers cope: whenever they signal that we're asking too much of them,
+    the limit is halved, and after a limit's worth of successful downloads, it's
+    raised by one again, up to the given maximum. This is the "additive
+    increase, multiplicative decrease" scheme known from TCP congestion control,
+    see https://en.wikipedia.org/wiki/Additive_increase/multiplicative_decrease.
+    Used as a context manager around each request.
+
+    Like in TCP, the limit is only halved once per "window": a burst of
+    concurrent requests being throttled (or one request being throttled again
+    on each retry) is a single signal, so after halving, further throttling is
+    ignored until the requests that were allowed at the time have finished.
+    """
+
+    def __init__(self, maximum=16):
+        self.maximum = maximum
+        self.limit = maximum
+        self.active = 0
+        self.successes = 0
+
+        # number of requests yet to finish before the limit may be halved again
+        self.cooldown = 0
+
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+        return self
+
+    def __exit__(self, *args):
+        with self.condition:
+            self.active -= 1
+            if self.cooldown > 0:
+                self.cooldown -= 1
+            self.condition.notify()
+
+    def feedback(self, throttled):
+        """Adjusts the limit based on whether a request has been throttled."""
+
+        with self.condition:
+            if throttled:
+                if self.cooldown > 0:
+                    return
+                self.cooldown = self.limit
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.maximum:
+                    self.limit += 1
+                    self.successes = 0
+                    self.condition.notify()
+
+
+THROTTLE = Throttle()
+
+
+class ThrottlingRetry(Retry):
+    """
+    Retry configuration that tells the throttle about every response in which
+    the tile servers signal that they're overwhelmed ("429 Too Many Requests"
+    or "503 Service Unavailable"), right as it's being retried – otherwise,
+    such responses would be absorbed by the retries, and the throttle would
+    only find out once they've been exhausted and the tile is lost anyway.
+    """
+
+    THROTTLING_STATUSES = frozenset([429, 503])
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if response is not None and response.status in self.THROTTLING_STATUSES:
+            THROTTLE.feedback(True)
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
 class MapTile:
     """
     A map tile: coordinates and, if it's been downloaded yet, image, plus some
-    housekeeping stuff.
+    housekeeping stuff. Grids can consist of many of these, so they're slotted
+    to save the memory (and lookup time) of a per-instance dict.
     """
 
-    def __init__(self, version, zoom, direction, x, y):
+    __slots__ = ("version", "zoom", "direction", "x", "y", "url_template", "status", "image", "content_hash")
+
+    def __init__(self, version, zoom, direction, x, y, url_template=None):
         self.version = version
         self.zoom = zoom
         self.direction = direction
         self.x = x
         self.y = y
 
+        # all tiles of a grid share version, zoom level, and direction, so the
+        # grid can pass in a template where only x and y remain to be filled in
+        if url_template is None:
+            url_template = MapTile.url_template_for(version, zoom, direction)
+        self.url_template = url_template
+
         # initialize the other variables
         self.status = MapTileStatus.PENDING
         self.image = None
+        self.content_hash = None
 
     def __repr__(self):
         return f"MapTile({self.version}, {self.zoom}, {self.direction}, {self.x}, {self.y})"
 
+    @staticmethod
+    def url_template_for(version, zoom, direction):
+        """
+        Returns the URL of tiles with the given version, zoom level, and
+        direction, with placeholders for their x and y coordinates.
+        """
+
+        url_template = "https://khms1.google.com/kh/v={version}?x={x}&y={y}&z={zoom}"
+        if direction.is_oblique():
+            url_template = "https://khms1.googleapis.com/kh?v={version}&deg={angle}&x={x}&y={y}&z={zoom}"
+        return url_template.format(version=version, angle=direction.angle, x="{x}", y="{y}", zoom=zoom)
+
     def load(self):
         """
-        Downloads the tile image if it hasn't been downloaded yet. Can be used
-        for retrying on errors.
+        Downloads the tile image if it hasn't been downloaded yet. Transient
+        errors are already retried (with backoff) by the session, see `main`.
         """
 
         if self.status != MapTileStatus.DOWNLOADED:
@@ -292,28 +570,63 @@ class MapTile:
 
         self.status = MapTileStatus.DOWNLOADING
 
+        # the same position of another version may have been downloaded before,
+        # in which case the server can tell us whether anything has changed
+        cache_key = (self.zoom, self.direction.angle, self.x, self.y)
+        cached = TILE_CACHE.get(cache_key)
+
         try:
-            url_template = "https://khms1.google.com/kh/v={version}?x={x}&y={y}&z={zoom}"
-            if self.direction.is_oblique():
-                url_template = "https://khms1.googleapis.com/kh?v={version}&deg={angle}&x={x}&y={y}&z={zoom}"
-            url = url_template.format(version=self.version, angle=self.direction.angle, x=self.x, y=self.y, zoom=self.zoom)
-            r = requests.get(url, headers={"User-Agent": USER_AGENT})
-        except requests.exceptions.ConnectionError:
+            url = self.url_template.format(x=self.x, y=self.y)
+            headers = {}
+            if cached:
+                headers["If-None-Match"] = cached[0]
+            with THROTTLE:
+                r = SESSION.get(url, headers=headers, timeout=TIMEOUT)
+        except requests.RequestException:
+
+            # any throttling along the way has already been reported to the
+            # throttle by the session's retries, see `ThrottlingRetry`
             self.status = MapTileStatus.ERROR
             return
 
+        THROTTLE.feedback(False)
+
         # error handling
-        if r.status_code != 200:
+        if r.status_code == 304 and cached:
+            data = cached[1]
+        elif r.status_code != 200:
             self.status = MapTileStatus.ERROR
             return
-
-        # convert response into an image
-        data = r.content
-        self.image = Image.open(io.BytesIO(data))
-
-        # sanity check
-        assert self.image.mode == "RGB"
-        assert self.image.size == (TILE_SIZE, TILE_SIZE)
+        else:
+            data = r.content
+            if "ETag" in r.headers:
+                TILE_CACHE.put(cache_key, r.headers["ETag"], data)
+
+        # convert response into an image, keeping a digest of the raw bytes
+        # around for cheap comparisons with other tiles (blake2b is faster than
+        # sha256 in software, and 16 bytes are plenty for telling tiles apart)
+        self.content_hash = hashlib.blake2b(data, digest_size=16).digest()
+        try:
+            image = Image.open(io.BytesIO(data))
+
+            # sanity check, which only needs the header – failing it (or failing
+            # to decode the image below) is treated like any other failed
+            # download instead of raising on the download thread, which would
+            # leave the tile stuck in the DOWNLOADING state
+            if image.mode != "RGB" or image.size != (TILE_SIZE, TILE_SIZE):
+                self.status = MapTileStatus.ERROR
+                return
+
+            # Image.open is lazy, so without this, all tiles would be decoded
+            # one after another during stitching – decoding here instead happens
+            # on the download threads, overlapping with other downloads (pillow
+            # releases the gil while decoding), leaving only the copying for
+            # `stitch`
+            image.load()
+        except OSError:
+            self.status = MapTileStatus.ERROR
+            return
+        self.image = image
 
         # done!
         self.status = MapTileStatus.DOWNLOADED
@@ -322,44 +635,50 @@ class MapTile:
 class ProgressIndicator:
     """
     Displays and updates a progress indicator during tile download. Designed
-    to run in a separate thread, polling for status updates frequently.
+    to run in a separate thread, redrawing whenever a tile has been loaded.
     """
 
+    # redraw at least this often such that tiles that have started downloading
+    # show up, but no more often than that minimum interval even if lots of
+    # tiles are loaded in quick succession
+    MAX_INTERVAL = 0.1
+    MIN_INTERVAL = 0.03
+
+    # how a single tile is displayed depending on its state: pending tiles are
+    # grayish, downloading tiles are yellow, successfully downloaded tiles are
+    # green, and tiles with errors are red. For each tile, two characters are
+    # printed – in most fonts, this is closer to a square than a single
+    # character. See https://stackoverflow.com/a/39452138 for color escapes.
+    GLYPHS = {
+        MapTileStatus.PENDING: "░░" + "\033[0m",
+        MapTileStatus.DOWNLOADING: "\033[33m" + "▒▒" + "\033[0m",
+        MapTileStatus.DOWNLOADED: "\033[32m" + "██" + "\033[0m",
+        MapTileStatus.ERROR: "\033[41m\033[37m" + "XX" + "\033[0m",
+    }
+
     def __init__(self, maptilegrid):
         self.maptilegrid = maptilegrid
+        self.stopped = False
 
-    def update_tile(self, maptile):
-        """
-        Updates a single tile depending on its state: pending tiles are grayish,
-        downloading tiles are yellow, successfully downloaded tiles are green,
-        and tiles with errors are red. For each tile, two characters are printed
-        – in most fonts, this is closer to a square than a single character.
-        See https://stackoverflow.com/a/39452138 for color escapes.
-        """
+        # tile statuses as of the last update, in the grid's flat order
+        self.drawn = None
 
-        def p(s): print(s + "\033[0m", end="")
+        # terminals that declare themselves "dumb" can't be relied upon to
+        # support the cursor movements needed for redrawing individual tiles
+        self.redraw_all = os.environ.get("TERM") == "dumb"
 
-        if maptile.status == MapTileStatus.PENDING:
-            p("░░")
-        elif maptile.status == MapTileStatus.DOWNLOADING:
-            p("\033[33m" + "▒▒")
-        elif maptile.status == MapTileStatus.DOWNLOADED:
-            p("\033[32m" + "██")
-        elif maptile.status == MapTileStatus.ERROR:
-            p("\033[41m\033[37m" + "XX")
+    def render_tile(self, maptile):
+        """Renders a single tile depending on its state."""
 
-    def update_text(self):
+        return self.GLYPHS[maptile.status]
+
+    def render_text(self):
         """
-        Displays percentage and counts only.
+        Renders percentage and counts only.
         """
 
-        downloaded = 0
-        errors = 0
-        for maptile in self.maptilegrid.flat():
-            if maptile.status == MapTileStatus.DOWNLOADED:
-                downloaded += 1
-            elif maptile.status == MapTileStatus.ERROR:
-                errors += 1
+        downloaded = self.maptilegrid.counts[MapTileStatus.DOWNLOADED]
+        errors = self.maptilegrid.counts[MapTileStatus.ERROR]
 
         total = self.maptilegrid.width * self.maptilegrid.height
         percent = int(10 * (100 * downloaded / total)) / 10
@@ -370,37 +689,94 @@ class ProgressIndicator:
             if errors > 1:
                 details += "s"
 
-
-        # need a line break after it so that the first line of the next
-        # iteration of the progress indicator starts at col 0
-        print(f"{percent}% ({details})")
+        return f"{percent}% ({details})"
 
     def update(self):
-        """Updates the progress indicator."""
+        """
+        Updates the progress indicator. The whole thing is assembled into a
+        single string first and then written in one go, as opposed to printing
+        each tile separately, which would be hundreds of writes per update.
+        Only the first update draws all tiles, later ones just redraw the tiles
+        whose status has changed since (unless the terminal is a dumb one).
+        """
 
+        statuses = [maptile.status for maptile in self.maptilegrid.flat()]
+        if self.drawn is None or self.redraw_all:
+            parts = self.render_all()
+        else:
+            parts = self.render_changes(statuses)
+        self.drawn = statuses
+
+        sys.stdout.write("".join(parts))
+        sys.stdout.flush()
+
+    def render_all(self):
+        """Renders all tiles plus the text below them."""
+
+        parts = []
         for y in range(self.maptilegrid.height):
             for x in range(self.maptilegrid.width):
                 maptile = self.maptilegrid.at(x, y)
-                self.update_tile(maptile)
-            print()  # line break
+                parts.append(self.render_tile(maptile))
+            parts.append("\n")
 
-        self.update_text()
+        # need a line break after the text so that the first line of the next
+        # iteration of the progress indicator starts at col 0
+        parts.append(self.render_text() + "\n")
 
         # move cursor back up to the beginning of the progress indicator for
         # the next iteration, see
         # http://www.tldp.org/HOWTO/Bash-Prompt-HOWTO/x361.html
-        print(f"\033[{self.maptilegrid.height + 1}A", end="")
+        parts.append(f"\033[{self.maptilegrid.height + 1}A")
+        return parts
+
+    def render_changes(self, statuses):
+        """
+        Renders only the tiles whose status differs from the last update, plus
+        the text. Each tile is reached by moving the cursor down from the first
+        line of the progress indicator (where the previous update has left it),
+        to the tile's column, and back up again.
+        """
+
+        height = self.maptilegrid.height
+        parts = []
+        for i, (status, drawn) in enumerate(zip(statuses, self.drawn)):
+            if status is drawn:
+                continue
+            x, y = divmod(i, height)
+            if y:
+                parts.append(f"\033[{y}B")
+            parts.append(f"\033[{2 * x + 1}G" + self.GLYPHS[status])
+            if y:
+                parts.append(f"\033[{y}A")
+
+        # the text is short, so just clear its line and rewrite it
+        parts.append(f"\033[{height}B\r" + self.render_text() + "\033[K")
+        parts.append(f"\033[{height}A\r")
+        return parts
 
     def loop(self):
         """Main loop."""
 
-        while any([maptile.status is MapTileStatus.PENDING or
-                   maptile.status is MapTileStatus.DOWNLOADING
-                   for maptile in self.maptilegrid.flat()]):
+        changed = self.maptilegrid.counts_changed
+        while not self.stopped:
             self.update()
-            time.sleep(0.1)
+            with changed:
+                if not self.stopped:
+                    changed.wait(timeout=self.MAX_INTERVAL)
+            time.sleep(self.MIN_INTERVAL)
         self.update()  # final update to show that we're all done
 
+    def stop(self):
+        """
+        Ends the main loop. It's up to the caller to say when downloading is
+        over, the tile counts alone can't tell whether more is to come.
+        """
+
+        with self.maptilegrid.counts_changed:
+            self.stopped = True
+            self.maptilegrid.counts_changed.notify_all()
+
     def cleanup(self):
         """Moves the cursor back to the bottom after completion."""
 
@@ -421,28 +797,47 @@ class MissingTilesError(Exception):
 
 class MapTileGrid:
     """
-    A grid of map tiles, kepts as a nested list such that indexing works via
-    [x][y]. Manages the download and stitching of map tiles into a preliminary
-    result image.
+    A grid of map tiles, passed in as a nested list such that indexing works
+    via [x][y], but stored column by column in a single flat tuple. Manages the
+    download and stitching of map tiles into a preliminary result image,
+    cropped by the given amount of pixels (left, top, right, bottom) at its
+    edges.
     """
 
-    def __init__(self, maptiles, version):
-        self.maptiles = maptiles
+    def __init__(self, maptiles, version, crop=(0, 0, 0, 0)):
         self.version = version
+        self.crop = crop
 
         self.width = len(maptiles)
         self.height = len(maptiles[0])
         self.image = None
 
+        # the grid never changes shape, so it only needs to be flattened once
+        self._flat = tuple(maptile for col in maptiles for maptile in col)
+
+        # number of tiles per status, kept up to date as tiles are loaded (see
+        # `load_tile`) such that the progress indicator doesn't need to scan
+        # the whole grid several times per second – waiting on the condition
+        # lets it redraw as soon as a tile has been loaded
+        self.counts = collections.Counter(maptile.status for maptile in self._flat)
+        self.counts_changed = threading.Condition()
+
     def __repr__(self):
-        return f"MapTileGrid({self.maptiles})"
+        cols = [list(self._flat[x * self.height:(x + 1) * self.height]) for x in range(self.width)]
+        return f"MapTileGrid({cols})"
 
     @classmethod
     def from_georect(cls, georect, zoom, direction, version):
-        """Divides a GeoRect into a grid of map tiles."""
+        """
+        Divides a GeoRect into a grid of map tiles. Also determines how much
+        needs to be cut off at the edges of the stitched-together tiles such
+        that they really only cover the area within the `GeoRect`.
+        """
 
-        bottomleft = georect.sw.to_maptile(version, zoom, direction)
-        topright = georect.ne.to_maptile(version, zoom, direction)
+        # project the corners of the rectangle into (fractional) tile
+        # coordinates – the integer part determines the tiles, the fractional
+        # part the cropping
+        left, bottom, right, top = georect.project(zoom, direction)
 
         # this swapping business is really only required when the direction is
         # "eastward", "southward", or "westward" since in these cases, tile
@@ -450,26 +845,49 @@ class MapTileGrid:
         # directions (where they match cardinal directions) – note that the
         # alternative to this sorting step would be four cases (similar to how
         # it's done in the `ObliqueWebMercator.project` function)
-        if bottomleft.x > topright.x:
-            bottomleft.x, topright.x = topright.x, bottomleft.x
-        if bottomleft.y < topright.y:
-            bottomleft.y, topright.y = topright.y, bottomleft.y
+        if left > right:
+            left, right = right, left
+        if bottom < top:
+            bottom, top = top, bottom
+
+        # determine what we'll cut off
+        left_crop = round(TILE_SIZE * (left % 1))
+        bottom_crop = round(TILE_SIZE * (1 - bottom % 1))
+        right_crop = round(TILE_SIZE * (1 - right % 1))
+        top_crop = round(TILE_SIZE * (top % 1))
 
+        # it's correct to have `top` (i.e. "north" when direction is "downward"
+        # or "northward") and `bottom` (i.e. similarly "south") reversed here
+        # (with regard to `left` and `right`) since the y axis of the tile
+        # coordinates points toward the south, while the latitude axis points
+        # due north
+        xmin, xmax = math.floor(left), math.floor(right)
+        ymin, ymax = math.floor(top), math.floor(bottom)
+
+        # if (after rounding to pixels) an edge of the rectangle coincides with
+        # a tile boundary, the row or column of tiles beyond it would be cut off
+        # entirely, so there's no need to download it in the first place
+        if left_crop == TILE_SIZE and xmin < xmax:
+            xmin, left_crop = xmin + 1, 0
+        if right_crop == TILE_SIZE and xmin < xmax:
+            xmax, right_crop = xmax - 1, 0
+        if top_crop == TILE_SIZE and ymin < ymax:
+            ymin, top_crop = ymin + 1, 0
+        if bottom_crop == TILE_SIZE and ymin < ymax:
+            ymax, bottom_crop = ymax - 1, 0
+
+        url_template = MapTile.url_template_for(version, zoom, direction)
         maptiles = []
-        for x in range(bottomleft.x, topright.x + 1):
+        for x in range(xmin, xmax + 1):
             col = []
-
-            # it's correct to have `topright` (i.e. "northeast" when direction
-            # is "downward" or "northward") and `bottomleft` (i.e. similarly
-            # "southwest") reversed here (with regard to the outer loop) since
-            # the y axis of the tile coordinates points toward the south, while
-            # the latitude axis points due north
-            for y in range(topright.y, bottomleft.y + 1):
-                maptile = MapTile(version, zoom, direction, x, y)
+            for y in range(ymin, ymax + 1):
+                maptile = MapTile(version, zoom, direction, x, y, url_template)
                 col.append(maptile)
             maptiles.append(col)
 
-        return cls(maptiles, version)
+        crop = (left_crop, top_crop, right_crop, bottom_crop)
+
+        return cls(maptiles, version, crop)
 
     def at(self, x, y):
         """Accessor with wraparound for negative values: x/y<0 => x/y+=w/h."""
@@ -478,17 +896,46 @@ class MapTileGrid:
             x += self.width
         if y < 0:
             y += self.height
-        return self.maptiles[x][y]
+        return self._flat[x * self.height + y]
+
+    @staticmethod
+    def morton(x, y):
+        """
+        Interleaves the bits of two non-negative integers, which yields a point's
+        position along a z-order curve, see
+        https://en.wikipedia.org/wiki/Z-order_curve.
+        """
+
+        key = 0
+        for bit in range(max(x.bit_length(), y.bit_length())):
+            key |= ((x >> bit) & 1) << (2 * bit) | ((y >> bit) & 1) << (2 * bit + 1)
+        return key
 
     def flat(self):
-        """Returns the grid as a flattened list."""
+        """Returns the grid as a flattened tuple."""
 
-        return [maptile for col in self.maptiles for maptile in col]
+        return self._flat
 
-    def download(self):
+    def load_tile(self, maptile):
         """
-        Downloads the constitudent tiles using a threadpool for performance
-        while updating the progress indicator.
+        Loads one of this grid's tiles (see `MapTile.load`) and updates the
+        per-status tile counts accordingly. Safe to call from multiple threads,
+        as long as no tile is loaded by two threads at once.
+        """
+
+        before = maptile.status
+        maptile.load()
+        with self.counts_changed:
+            self.counts[before] -= 1
+            self.counts[maptile.status] += 1
+            self.counts_changed.notify_all()
+
+    def download(self, executor):
+        """
+        Downloads the constitudent tiles using the given threadpool for
+        performance while updating the progress indicator. The threadpool is
+        meant to be shared between grids such that its threads (and their
+        connections) are kept warm across versions.
         """
 
         # set up progress indicator
@@ -497,25 +944,25 @@ class MapTileGrid:
         prog_thread.start()
 
         # shuffle the download order of the tiles, this serves no actual purpose
-        # but it makes the progress indicator look really cool!
-        tiles = self.flat()
-        random.shuffle(tiles)
+        # but it makes the progress indicator look really cool! For large grids
+        # (where the progress indicator is a wall of colors anyway), download
+        # them along a z-order curve instead such that consecutive requests are
+        # for nearby tiles, which are more likely to be cached together on
+        # google's end
+        tiles = list(self.flat())
+        if len(tiles) < 256:
+            random.shuffle(tiles)
+        else:
+            tiles.sort(key=lambda maptile: MapTileGrid.morton(maptile.x, maptile.y))
 
         # download tiles using threadpool (2-10 times faster than
         # [maptile.load() for maptile in self.flat()]), see
         # https://docs.python.org/dev/library/concurrent.futures.html#threadpoolexecutor-example
-        threads = max(self.width, self.height)
-        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
-            {executor.submit(maptile.load): maptile for maptile in tiles}
-
-        # retry failed downloads if fewer than 20% of tiles are missing
-        missing_tiles = [maptile for maptile in self.flat() if maptile.status == MapTileStatus.ERROR]
-        if 0 < len(missing_tiles) < 0.2 * len(self.flat()):
-            print("Retrying missing tiles...")
-            for maptile in missing_tiles:
-                maptile.load()
+        futures = {executor.submit(self.load_tile, maptile): maptile for maptile in tiles}
+        concurrent.futures.wait(futures)
 
         # finish up progress indicator
+        prog.stop()
         prog_thread.join()
         prog.cleanup()
 
@@ -533,55 +980,77 @@ class MapTileGrid:
         return [self.at(x, y) for x in [0, -1] for y in [0, -1]]
 
 
+    def download_corners(self, executor):
+        """
+        Downloads only the four corner tiles of the grid (using the given
+        threadpool), which is enough to decide whether the grid is worth
+        downloading in full. Since loaded tiles aren't downloaded again, a later
+        call to `download` only fetches the remaining tiles.
+        """
+
+        # deduplicate since corners coincide for grids one tile wide or high
+        corners = list(dict.fromkeys(self.corners()))
+
+        futures = {executor.submit(self.load_tile, maptile): maptile for maptile in corners}
+        concurrent.futures.wait(futures)
+
+        missing_tiles = [maptile for maptile in corners if maptile.status == MapTileStatus.ERROR]
+        if missing_tiles:
+            raise MissingTilesError(f"unable to download one or more corner tiles", len(missing_tiles), len(corners))
+
     def corners_identical_to(self, other):
         """
         Checks whether the four corners of this grid are identical to the ones
-        from another grid. The other grid MUST already be fully loaded (or, at
-        least, its corners must be available).
+        from another grid. The corners of both grids MUST already be loaded,
+        see `download_corners`.
         """
 
         self_corners = self.corners()
         other_corners = other.corners()
-        assert all([maptile.status == MapTileStatus.DOWNLOADED for maptile in other_corners])
+        assert all([maptile.status == MapTileStatus.DOWNLOADED for maptile in self_corners + other_corners])
 
-        # download self's corners
-        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-            {executor.submit(maptile.load): maptile for maptile in self_corners}
+        # super basic difference metric: the corners are identical if their
+        # pixels are – comparing the raw pixel buffers (which costs about as
+        # much as computing a difference image and its bounding box) is way
+        # faster than looping over the pixels in python, which took 0.2s on my
+        # early 2015 laptop for all four corners combined
+        for self_corner, other_corner in zip(self_corners, other_corners):
 
-        # retry
-        missing_tiles = [maptile for maptile in self_corners if maptile.status == MapTileStatus.ERROR]
-        for maptile in missing_tiles:
-            maptile.load()
-        missing_tiles = [maptile for maptile in self_corners if maptile.status == MapTileStatus.ERROR]
-        if missing_tiles:
-            raise MissingTilesError(f"unable to download one or more corner tiles", len(missing_tiles), len(self_corners))
+            # google serves the very same file if the imagery hasn't changed, so
+            # identical hashes mean there's no need to look at the pixels at all
+            if self_corner.content_hash == other_corner.content_hash:
+                continue
 
-        # super basic difference metric: just sum up the differences of each
-        # channel for every pixel (for every corner) – you'd think this would be
-        # slow, but it takes 0.2s on my early 2015 laptop for all four combined
-        # (the connection setup latency during download is the limiting factor!)
-        for self_corner, other_corner in zip(self_corners, other_corners):
-            diff = ImageChops.difference(self_corner.image, other_corner.image)
-            if any([True for channels in list(diff.getdata()) if channels != (0, 0, 0)]):
+            if self_corner.image.tobytes() != other_corner.image.tobytes():
                 return False
 
         return True
 
     def stitch(self):
         """
-        Stitches the tiles comprising this grid together. Must not be called
-        before all tiles have been loaded.
+        Stitches the tiles comprising this grid together, cropping as it goes:
+        the image is only allocated at its cropped size, with tiles at the edges
+        pasted partially outside of it (pillow clips them). This avoids ever
+        materializing the pixels that would be cut off anyway. Must not be
+        called before all tiles have been loaded.
+
+        Once pasted, the tile images are released – except for the corners,
+        which are still needed for comparison with the next version.
         """
 
-        image = Image.new("RGB", (self.width * TILE_SIZE, self.height * TILE_SIZE))
-        for x in range(0, self.width):
-            for y in range(0, self.height):
-                image.paste(self.maptiles[x][y].image, (x * TILE_SIZE, y * TILE_SIZE))
+        corners = set(self.corners())
+        left, top, right, bottom = self.crop
+        image = Image.new("RGB", (self.width * TILE_SIZE - left - right, self.height * TILE_SIZE - top - bottom))
+        for i, maptile in enumerate(self._flat):
+            x, y = divmod(i, self.height)
+            image.paste(maptile.image, (x * TILE_SIZE - left, y * TILE_SIZE - top))
+            if maptile not in corners:
+                maptile.image = None
         self.image = image
 
 
 class MapTileImage:
-    """Image cropping, resizing and enhancement."""
+    """Image resizing and enhancement."""
 
     def __init__(self, image, version):
         self.image = image
@@ -590,45 +1059,72 @@ class MapTileImage:
     def save(self, path, quality=90):
         self.image.save(path, quality=quality)
 
-    def crop(self, zoom, direction, georect):
+    def scale(self, width, height):
         """
-        Crops the image such that it really only covers the area within the
-        input `GeoRect`. This function must only be called once per image.
+        Scales an image. This can distort the image if width and height don't
+        match the original aspect ratio.
         """
 
-        left, bottom = WebMercator.project(georect.sw, zoom)  # sw_x, sw_y
-        right, top = WebMercator.project(georect.ne, zoom)  # ne_x, ne_y
-        if direction.is_oblique():
-            left, bottom = ObliqueWebMercator.project(georect.sw, zoom, direction)
-            right, top = ObliqueWebMercator.project(georect.ne, zoom, direction)
+        # Image.LANCZOS apparently provides the best quality, see
+        # https://pillow.readthedocs.io/en/latest/handbook/concepts.html#concept-filters
+        # – when downscaling by a lot, convolving over the whole source image is
+        # slow, so first shrink it by an integer factor with a cheap box filter,
+        # stopping at 3 times the target size, which according to
+        # https://pillow.readthedocs.io/en/stable/reference/Image.html#PIL.Image.Image.resize
+        # is indistinguishable from doing it all with lanczos in most cases
+        self.image = self.image.resize((round(width), round(height)), resample=Image.LANCZOS, reducing_gap=3.0)
 
-        # swapping (and naming) analogous to how/why it's done in
-        # `MapTileGrid.from_georect`
-        if left > right:
-            left, right = right, left
-        if bottom < top:
-            bottom, top = top, bottom
+    @staticmethod
+    def quantize_jointly(images, executor, colors=256):
+        """
+        Quantizes a bunch of images to a single shared palette, which is
+        computed from all of them stacked on top of each other. Mapping each
+        image onto the palette is independent of the others, and since pillow
+        doesn't release the gil while doing so, this happens on the given
+        process pool.
+        """
 
-        # determine what we'll cut off
-        left_crop = round(TILE_SIZE * (left % 1))
-        bottom_crop = round(TILE_SIZE * (1 - bottom % 1))
-        right_crop = round(TILE_SIZE * (1 - right % 1))
-        top_crop = round(TILE_SIZE * (top % 1))
+        width = max(image.width for image in images)
+        height = sum(image.height for image in images)
+        stacked = Image.new("RGB", (width, height))
+        offset = 0
+        for image in images:
+            stacked.paste(image, (0, offset))
+            offset += image.height
 
-        crop = (left_crop, top_crop, right_crop, bottom_crop)
+        quantized = stacked.quantize(colors=colors)
+        del stacked
 
-        # snip snap
-        self.image = ImageOps.crop(self.image, crop)
+        # only the palette is of interest, and it's sent along to every worker
+        # process – carrying it on a 1x1 image instead of the quantized stack
+        # (which holds the pixels of every frame) keeps that cheap
+        palette = Image.new("P", (1, 1))
+        palette.putpalette(quantized.getpalette())
+        del quantized
 
-    def scale(self, width, height):
+        return list(executor.map(functools.partial(Image.Image.quantize, palette=palette), images))
+
+    @staticmethod
+    def mask_unchanged(frames, transparent_index):
         """
-        Scales an image. This can distort the image if width and height don't
-        match the original aspect ratio.
+        Given palette images sharing the same palette, sets all pixels that are
+        identical to the previous frame's to the given (otherwise unused)
+        palette index. Meant for GIF frames, which are drawn on top of each
+        other if they aren't disposed of: if that index is declared transparent,
+        the animation looks the same, but long runs of identical indices
+        compress much better than scattered imagery.
         """
 
-        # Image.LANCZOS apparently provides the best quality, see
-        # https://pillow.readthedocs.io/en/latest/handbook/concepts.html#concept-filters
-        self.image = self.image.resize((round(width), round(height)), resample=Image.LANCZOS)
+        # comparing the palette indices as grayscale values, since only exact
+        # equality matters, then turning that into a mask of unchanged pixels
+        indices = [Image.frombytes("L", frame.size, frame.tobytes()) for frame in frames]
+        masked = [frames[0]]
+        for frame, current, previous in zip(frames[1:], indices[1:], indices):
+            unchanged = ImageChops.difference(current, previous).point(lambda v: 255 if v == 0 else 0)
+            frame = frame.copy()
+            frame.paste(transparent_index, mask=unchanged)
+            masked.append(frame)
+        return masked
 
 
 class Printer:
@@ -677,6 +1173,12 @@ def main():
         default=argparse.SUPPRESS,
         help=f"Current Google Maps version. This tool tries to determine it automatically, but if that fails (due to a changes on Google's end, for instance), you can override the likely-outdated default/fallback: Navigate to Google Maps in your browser, open its developer tools, and search the HTML source code of the page for the string 'khms0.google.com/kh/v\\u003d'. The number right after the 'd' is the current version. (default: {DEFAULT_VERSION} for 'downward' view direction, {DEFAULT_OBLIQUE_VERSION} for others)"
     )
+    optional.add_argument("-p", "--parallel",
+        metavar="N",
+        type=int,
+        default=16,
+        help="Maximum number of map tiles to download concurrently. Higher values speed things up until your connection (or Google's patience) runs out."
+    )
 
     pointy = parser.add_argument_group("Point of interest")
     pointy.add_argument("point",
@@ -736,19 +1238,25 @@ def main():
     output.add_argument("-f", "--format",
         dest="output_format",
         type=str,
-        choices=["jpegs", "gif", "both"],
+        choices=["jpegs", "gif", "both", "webp"],
         default="both",
-        help="Output format: 'jpegs' will output a bunch of JPEGs, 'gif' will collect them into a GIF instead (with the usual fidelity and filesize implications), 'both' will do both."
+        help="Output format: 'jpegs' will output a bunch of JPEGs, 'gif' will collect them into a GIF instead (with the usual fidelity and filesize implications), 'both' will do both. 'webp' will collect them into an animated WebP, which isn't limited to 256 colors and usually much smaller than a GIF, but not quite as universally supported (and requires Pillow to be built with WebP support)."
     )
     output.add_argument("-q", "--quality",
         type=int,
         default=90,
-        help="JPEG compression quality (0-100), only relevant if JPEGs are emitted."
+        help="JPEG (or WebP) compression quality (0-100), only relevant if JPEGs (or an animated WebP) are emitted."
     )
     output.add_argument("-r", "--framerate",
         type=float,
         default=3,
-        help="Number of frames per second, only relevant if GIFs are emitted."
+        help="Number of frames per second, only relevant if a GIF (or an animated WebP) is emitted."
+    )
+    output.add_argument("-o", "--optimize-gif",
+        dest="optimize_gif",
+        default=argparse.SUPPRESS,
+        action="store_true",
+        help="Quantize all frames of the GIF to one shared 256-color palette instead of giving each frame its own. This usually yields smaller GIFs with less flickering between frames, but all frames need to be kept in memory at full color until the GIF is written. If \033[3mgifsicle\033[0m is installed, it's used to squeeze the GIF some more afterwards."
     )
     output.add_argument("-s", "--simpler-filenames",
         dest="simpler_filenames",
@@ -776,12 +1284,9 @@ def main():
     current_version = DEFAULT_VERSION
     if direction.is_oblique():
         current_version = DEFAULT_OBLIQUE_VERSION
-    if hasattr(args, "current_version"):
-        current_version = args.current_version
+    current_version = getattr(args, "current_version", current_version)
 
-    max_meters_per_pixel = None
-    if hasattr(args, "max_meters_per_pixel"):
-        max_meters_per_pixel = args.max_meters_per_pixel
+    max_meters_per_pixel = getattr(args, "max_meters_per_pixel", None)
 
     width = args.width
     height = args.height
@@ -794,16 +1299,17 @@ def main():
     if direction.is_eastward() or direction.is_westward():
         geowidth, geoheight = geoheight, geowidth
 
-    image_width = None
-    image_height = None
-    if hasattr(args, "image_width"):
-        image_width = args.image_width
-    if hasattr(args, "image_height"):
-        image_height = args.image_height
+    image_width = getattr(args, "image_width", None)
+    image_height = getattr(args, "image_height", None)
+
+    parallel = args.parallel
+    if parallel < 1:
+        raise ValueError("at least one map tile needs to be downloaded at a time, so the number of parallel downloads must be 1 or more")
 
     output_format = args.output_format
     quality = args.quality
     framerate = args.framerate
+    optimize_gif = hasattr(args, "optimize_gif")
 
     image_path_template = "googlemapsat88mph-{datetime}-{direction}-v{versions}-x{xmin}..{xmax}y{ymin}..{ymax}-z{zoom}-{latitude},{longitude}-{width}x{height}m"
     if hasattr(args, "simpler_filenames"):
@@ -813,21 +1319,15 @@ def main():
     if direction.is_oblique():
         foreshortening_factor = math.sqrt(2)
 
-    # process max_meters_per_pixel option
+    # process max_meters_per_pixel option – if both image width and height are
+    # set, effectively use whatever imposes a tighter constraint
     if image_width is None and image_height is None:
         if max_meters_per_pixel is None:
             raise ValueError("neither image height nor width given, so a maximum meters per pixel constraint needs to be specified")
-    elif image_height is None:
-        max_meters_per_pixel = (max_meters_per_pixel or 1) * (width / image_width)
-    elif image_width is None:
-        max_meters_per_pixel = (max_meters_per_pixel or 1) * (height / image_height) / foreshortening_factor
     else:
-
-        # if both are set, effectively use whatever imposes a tighter constraint
-        if width / image_width <= (height / image_height) / foreshortening_factor:
-            max_meters_per_pixel = (max_meters_per_pixel or 1) * (width / image_width)
-        else:
-            max_meters_per_pixel = (max_meters_per_pixel or 1) * (height / image_height) / foreshortening_factor
+        width_constraint = width / image_width if image_width is not None else math.inf
+        height_constraint = (height / image_height) / foreshortening_factor if image_height is not None else math.inf
+        max_meters_per_pixel = (max_meters_per_pixel or 1) * min(width_constraint, height_constraint)
 
     # process image width and height for scaling
     if image_width is not None or image_height is not None:
@@ -836,21 +1336,63 @@ def main():
         elif image_width is None:
             image_width = width * (image_height / height) * foreshortening_factor
 
+    # size the connection pool such that each download thread can keep its
+    # connection alive instead of having it discarded after every tile, and
+    # transparently retry (with backoff, and honoring any "Retry-After" header)
+    # on connection problems and transient server errors or throttling (which
+    # is also reported to the throttle) – 404s aren't retried, they just mean
+    # that a tile doesn't exist in a version
+    retry = ThrottlingRetry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], respect_retry_after_header=True)
+    SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=parallel, pool_maxsize=parallel, max_retries=retry))
+
+    # start out at the requested parallelism, backing off if google objects
+    THROTTLE.maximum = THROTTLE.limit = parallel
+
+    # one threadpool for all tile downloads of all versions – since this is
+    # network-bound, the tile servers rather than the grid dimensions limit how
+    # many concurrent downloads make sense
+    downloader = concurrent.futures.ThreadPoolExecutor(max_workers=parallel)
+
     ############################################################################
 
     printer.info("Determining current Google Maps version (we'll work our way backwards from there)...")
-    try:
-        google_maps_page = requests.get("https://maps.googleapis.com/maps/api/js", headers={"User-Agent": USER_AGENT}).content
-        match = re.search(rb'null,\[\[\"https:\/\/khms0\.googleapis\.com\/kh\?v=([0-9]+)', google_maps_page)
-        if direction.is_oblique():
-            match = re.search(rb'\],\[\[\"https:\/\/khms0\.googleapis\.com\/kh\?v=([0-9]+)', google_maps_page)
-        if match:
-            current_version = int(match.group(1).decode("ascii"))
-            printer.debug(current_version)
-        else:
-            printer.warn(f"Unable to extract current version, proceeding with outdated version {current_version} instead.")
-    except requests.RequestException:
-        printer.warn(f"Unable to load Google Maps, proceeding with outdated version {current_version} instead.")
+
+    # skip the request if the current version has been determined just recently
+    version_kind = "oblique" if direction.is_oblique() else "satellite"
+    cached_version = VERSION_CACHE.get(version_kind)
+    if cached_version is not None:
+        current_version = cached_version
+        printer.debug(current_version)
+    else:
+        try:
+            pattern = VERSION_PATTERN
+            if direction.is_oblique():
+                pattern = OBLIQUE_VERSION_PATTERN
+
+            # the versions are mentioned well before the end of the script, so
+            # stream it in chunks and stop reading as soon as there's a match
+            # (only the tail of what's been read so far needs to be searched
+            # again, with some overlap in case a match straddles two chunks)
+            match = None
+            google_maps_page = bytearray()
+            with SESSION.get("https://maps.googleapis.com/maps/api/js", stream=True, timeout=TIMEOUT) as r:
+                for chunk in r.iter_content(chunk_size=65536):
+                    start = max(0, len(google_maps_page) - 256)
+                    google_maps_page += chunk
+                    match = pattern.search(google_maps_page, start)
+
+                    # unless the version number might continue in the next chunk
+                    if match and match.end() < len(google_maps_page):
+                        break
+
+            if match:
+                current_version = int(match.group(1).decode("ascii"))
+                printer.debug(current_version)
+                VERSION_CACHE.put(version_kind, current_version)
+            else:
+                printer.warn(f"Unable to extract current version, proceeding with outdated version {current_version} instead.")
+        except requests.RequestException:
+            printer.warn(f"Unable to load Google Maps, proceeding with outdated version {current_version} instead.")
 
     printer.info("Computing required tile zoom level at specified point...")
     zoom = p.compute_zoom_level(max_meters_per_pixel)
@@ -864,8 +1406,60 @@ def main():
 
     printer.info("Alrighty, prep work's done!")
 
+    # gifs are limited to 256 colors per frame, so each frame is quantized
+    # right away (in the background, while the next version is downloading) –
+    # that way, only one byte per pixel needs to be retained instead of three
+    # (the fast octree method is several times faster than the default median
+    # cut and plenty good enough for a single frame of satellite imagery).
+    # Pillow holds on to the gil while quantizing, so this is done in separate
+    # processes, which can actually make use of multiple cores (and don't slow
+    # down the download threads) – they're spawned rather than forked, since
+    # forking a process that's running threads (like the downloaders) can
+    # leave locks held forever in the child, see
+    # https://docs.python.org/3/library/multiprocessing.html#contexts-and-start-methods
+    quantizer = concurrent.futures.ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"))
+
+    # parts of the output filenames that are the same for all versions (the
+    # timestamp is taken once such that all files of one run share it)
+    image_path_fields = {
+        "datetime": datetime.today().strftime("%Y-%m-%dT%H.%M.%S"),
+        "direction": args.direction,
+        "zoom": zoom,
+        "latitude": p.lat,
+        "longitude": p.lon,
+        "width": width,
+        "height": height
+    }
+
+    def finish(grid, version, image_path):
+        grid.stitch()
+        image = MapTileImage(grid.image, version)
+
+        # the grid sticks around until the next version has been compared with
+        # it, but its unscaled image doesn't need to
+        grid.image = None
+
+        if image_width is not None or image_height is not None:
+            image.scale(image_width, image_height)
+
+        if image_path is not None:
+            image.save(image_path, quality)
+
+        if output_format != "jpegs":
+            if output_format == "webp" or optimize_gif:
+
+                # webp isn't palette-based, and a shared gif palette can
+                # only be computed once all frames are known
+                frames.append(image.image)
+            else:
+                frames.append(quantizer.submit(image.image.quantize, colors=256, method=Image.FASTOCTREE))
+
+    finisher = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    finishing = None
+
     previous_grid = None
-    downloaded_images = []
+    downloaded_versions = []
+    frames = []
     skipped_versions = 0
     for version in range(current_version, -1, -1):
         try:
@@ -875,9 +1469,22 @@ def main():
             grid = MapTileGrid.from_georect(rect, zoom, direction, version)
             printer.debug(grid)
 
-            # if we're not on the first iteration, check if the imagery differs at the corners
+            # the tile extents are the same for every version, so they can join
+            # the other version-independent filename fields right away
+            if version == current_version:
+                origin = grid.at(0, 0)
+                image_path_fields.update({
+                    "xmin": origin.x,
+                    "xmax": origin.x + grid.width,
+                    "ymin": origin.y,
+                    "ymax": origin.y + grid.height
+                })
+
+            # if we're not on the first iteration, check if the imagery differs
+            # at the corners before committing to downloading the whole grid
             if version != current_version:
                 printer.info("Downloading corner tiles and comparing with previously downloaded version...")
+                grid.download_corners(downloader)
                 if grid.corners_identical_to(previous_grid):
                     printer.info("Imagery seems identical, going to next version instead of downloading this one...")
                     continue
@@ -886,44 +1493,31 @@ def main():
             previous_grid = grid
 
             printer.info("Downloading tiles...")
-            grid.download()
-
-            printer.info("Stitching tiles together into an image...")
-            grid.stitch()
-            image = MapTileImage(grid.image, version)
-
-            printer.info("Cropping image to match the chosen area width and height...")
-            printer.debug((width, height))
-            image.crop(zoom, direction, rect)
-
+            grid.download(downloader)
+
+            # stitching, scaling and encoding are cpu-bound and mostly release
+            # the gil, so they're done on a background thread while the next
+            # version's corners and tiles are already being downloaded – but
+            # only one version at a time so as to not pile up grids in memory
+            if finishing is not None:
+                finishing.result()
+            printer.info("Stitching, scaling and saving image in the background while moving on...")
+            printer.debug(grid.crop)
             if image_width is not None or image_height is not None:
-                printer.info("Scaling image...")
                 printer.debug((image_width, image_height))
-                image.scale(image_width, image_height)
-
-            if output_format != "gif":
-                printer.info("Saving image to disk...")
-
-                image_path = (image_path_template + ".jpg").format(
-                    datetime=datetime.today().strftime("%Y-%m-%dT%H.%M.%S"),
-                    direction=args.direction,
-                    versions=version,
-                    xmin=grid.at(0, 0).x,
-                    xmax=grid.at(0, 0).x+grid.width,
-                    ymin=grid.at(0, 0).y,
-                    ymax=grid.at(0, 0).y+grid.height,
-                    zoom=zoom,
-                    latitude=p.lat,
-                    longitude=p.lon,
-                    width=width,
-                    height=height
-                )
+
+            image_path = None
+            if output_format in ["jpegs", "both"]:
+                image_path = (image_path_template + ".jpg").format(versions=version, **image_path_fields)
                 printer.debug(image_path)
-                image_quality = quality
-                image.save(image_path, image_quality)
 
-            # keep track of downloaded images for gif writing
-            downloaded_images.append(image)
+            # keep track of downloaded images for gif writing – if no gif is
+            # going to be written, there's no need to hold on to every version's
+            # pixels until the very end, which can add up to gigabytes for large
+            # areas with lots of versions
+            if output_format != "jpegs":
+                downloaded_versions.append(version)
+            finishing = finisher.submit(finish, grid, version, image_path)
 
             # reset skipped versions counter
             skipped_versions = 0
@@ -945,33 +1539,66 @@ def main():
             # otherwise, exit with some semblance of grace
             printer.info(f"It appears as though versions {version + skipped_versions} through {version} (and probably more) have been purged, or your internet connection has (at least partially) disappeared – either way, this seems to be the end of the line.")
 
-            if output_format != "jpeg":
+            # wait for the most recent version to be saved (and its frame to be
+            # appended) before wrapping up
+            if finishing is not None:
+                finishing.result()
+
+            if output_format != "jpegs":
 
                 # reverse downloaded images list to proceed from oldest to newest
-                downloaded_images.reverse()
+                downloaded_versions.reverse()
+                frames.reverse()
+
+                extension = ".webp" if output_format == "webp" else ".gif"
+                versions = ",".join(map(str, downloaded_versions))
+                image_path = (image_path_template + extension).format(versions=versions, **image_path_fields)
+
+                # in whole milliseconds, which is what the encoders work with
+                duration = max(1, round(1000 / framerate))
+
+            if output_format == "webp":
+                printer.info("Writing animated WebP...")
+                frames[0].save(image_path, append_images=frames[1:], save_all=True, duration=duration, loop=0, quality=quality)
+                printer.debug(image_path)
+
+            elif output_format != "jpegs":
+                if optimize_gif:
+
+                    # keep the last palette index free for marking pixels that
+                    # haven't changed since the previous frame as transparent
+                    printer.info("Quantizing frames to a shared palette and masking unchanged pixels...")
+                    frames = MapTileImage.quantize_jointly(frames, quantizer, colors=255)
+                    frames = MapTileImage.mask_unchanged(frames, 255)
+                    gif_options = {"transparency": 255, "disposal": 1}
+                else:
+                    frames = [frame.result() for frame in frames]
+                    gif_options = {}
 
                 printer.info("Writing GIF...")
-                image_path = (image_path_template + ".gif").format(
-                    datetime=datetime.today().strftime("%Y-%m-%dT%H.%M.%S"),
-                    direction=args.direction,
-                    versions=",".join(map(lambda i: str(i.version), downloaded_images)),
-                    xmin=grid.at(0, 0).x,
-                    xmax=grid.at(0, 0).x+grid.width,
-                    ymin=grid.at(0, 0).y,
-                    ymax=grid.at(0, 0).y+grid.height,
-                    zoom=zoom,
-                    latitude=p.lat,
-                    longitude=p.lon,
-                    width=width,
-                    height=height
-                )
-                downloaded_images[0].image.save(image_path, append_images=[i.image for i in downloaded_images[1:]], save_all=True, duration=1000/framerate, loop=0)
+                frames[0].save(image_path, append_images=frames[1:], save_all=True, duration=duration, loop=0, **gif_options)
                 printer.debug(image_path)
 
+                # gifsicle's lzw encoder and frame optimizations are quite a bit
+                # better than pillow's, see https://www.lcdf.org/gifsicle/ – but
+                # it's not a python package, so it's only used if available
+                if optimize_gif and shutil.which("gifsicle"):
+                    printer.info("Optimizing GIF with gifsicle...")
+                    result = subprocess.run(["gifsicle", "--batch", "-O3", image_path])
+                    if result.returncode != 0:
+                        printer.warn("Unable to optimize GIF with gifsicle, keeping it as-is.")
+
             printer.info("All done! 🛰")
 
             # exit the loop (thereby terminate the program)
             break
 
+    # surface any error from saving the last version if the loop ran all the
+    # way down to version 0 without hitting the end of the line
+    if finishing is not None:
+        finishing.result()
+
+    quantizer.shutdown()
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,101 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from urllib3.exceptions import MaxRetryError
+
+import googlemapsat88mph as g
+
+
+class FakeResponse:
+    """Just enough of a urllib3 response for `Retry.increment`."""
+
+    def __init__(self, status):
+        self.status = status
+        self.headers = {}
+
+    def get_redirect_location(self):
+        return False
+
+    def getheader(self, name, default=None):
+        return default
+
+
+class ThrottleTest(unittest.TestCase):
+
+    def throttled_burst(self, throttle, n):
+        """Runs n concurrent requests, all of which are throttled."""
+
+        # otherwise, some would wait for the others forever
+        self.assertLessEqual(n, throttle.limit)
+        entered = threading.Barrier(n)
+
+        def request():
+            with throttle:
+                entered.wait()
+                throttle.feedback(True)
+
+        threads = [threading.Thread(target=request) for _ in range(n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_concurrent_throttling_halves_once(self):
+        throttle = g.Throttle(16)
+        self.throttled_burst(throttle, 16)
+        self.assertEqual(throttle.limit, 8)
+
+    def test_throttling_after_window_halves_again(self):
+        throttle = g.Throttle(16)
+        self.throttled_burst(throttle, 16)
+        self.throttled_burst(throttle, 8)
+        self.assertEqual(throttle.limit, 4)
+
+    def test_retried_throttling_halves_once(self):
+        self.addCleanup(setattr, g, "THROTTLE", g.THROTTLE)
+        g.THROTTLE = g.Throttle(16)
+        retry = g.ThrottlingRetry(total=3, status_forcelist=[429])
+        with g.THROTTLE:
+            with self.assertRaises(MaxRetryError):
+                for _ in range(4):
+                    retry = retry.increment("GET", "/", response=FakeResponse(429))
+        self.assertEqual(g.THROTTLE.limit, 8)
+
+
+class VersionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.cache = g.VersionCache(os.path.join(self.directory, "versions.json"))
+
+    def test_roundtrip(self):
+        self.assertIsNone(self.cache.get("satellite"))
+        self.cache.put("satellite", 908)
+        self.assertEqual(self.cache.get("satellite"), 908)
+        self.assertIsNone(self.cache.get("oblique"))
+
+    def test_stale(self):
+        self.cache.put("satellite", 908)
+        self.cache.ttl = 0
+        self.assertIsNone(self.cache.get("satellite"))
+
+    def test_unexpected_json_is_ignored(self):
+        with open(self.cache.path, "w") as f:
+            json.dump([1, 2], f)
+        self.assertIsNone(self.cache.get("satellite"))
+        self.cache.put("satellite", 908)
+        self.assertEqual(self.cache.get("satellite"), 908)
+
+    def test_failed_write_leaves_no_temporary_file(self):
+        os.mkdir(self.cache.path)  # can't be replaced by a file
+        self.cache.put("satellite", 908)
+        self.assertEqual(os.listdir(self.directory), ["versions.json"])
+
+
+if __name__ == "__main__":
+    unittest.main()